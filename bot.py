@@ -1,17 +1,32 @@
 # -*- coding: utf-8 -*-
 """
-NPE Broker Support - Shift Management Bot (FULL PRO - Polling)
+NPE Broker Support - Shift Management Bot (FULL PRO - Polling/Webhook)
 Author: Arsh (Superuser)
 """
 
 import os
+import time
+import signal
+import contextlib
+import hashlib
+import queue
 import sqlite3
 import asyncio
+import logging
+import logging.handlers
 import threading
+from concurrent.futures import Future
+from itertools import groupby
+from operator import itemgetter
 from datetime import datetime, timedelta, time as dtime
 
+import uvicorn
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
-from flask import Flask
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
 
 from telegram import (
     Update,
@@ -20,6 +35,7 @@ from telegram import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
 )
+from telegram.error import Forbidden, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -27,6 +43,7 @@ from telegram.ext import (
     ConversationHandler,
     ContextTypes,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
 )
 
@@ -40,15 +57,32 @@ if not BOT_TOKEN:
     raise ValueError("❌ BOT_TOKEN is missing! Set it in Render Environment Variables.")
 
 PORT = int(os.getenv("PORT", 10000))
+
+# Public base URL (e.g. https://npe-shift-bot.onrender.com). When set, Telegram
+# pushes updates to {WEBHOOK_URL}/webhook; when empty the bot long-polls (local dev).
+# Render exports RENDER_EXTERNAL_URL itself, so deployments there use the webhook by default.
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL", "")).rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+# Only the update types we have handlers for; Telegram won't push (or poll) the rest
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
 DB_NAME = "attendance.db"
 
 COMPANY_NAME = "NPE Broker Support"
 
+# Max Telegram sends in flight at once / per second (Telegram allows ~30 msg/s per bot)
+SEND_CONCURRENCY = 25
+SEND_RATE_PER_SECOND = 25
+SEND_RETRIES = 3
+# Telegram caps a text message at 4096 UTF-16 code units (emoji outside the BMP count as two)
+MESSAGE_MAX_LENGTH = 4096
+# Pending employees per approval message (two inline buttons each; Telegram caps a keyboard at 100)
+PENDING_PAGE_SIZE = 25
+
 # =============================================================================
 # ROLES
 # =============================================================================
-REAL_MANAGERS = {97965212, 1035761242}   # Parham, Tohiid
-SUPERUSER = {6017492841}                # Creator (you)
+REAL_MANAGERS = frozenset({97965212, 1035761242})   # Parham, Tohiid
+SUPERUSER = frozenset({6017492841})                # Creator (you)
 ADMIN_USERS = REAL_MANAGERS | SUPERUSER
 
 # =============================================================================
@@ -60,6 +94,13 @@ SHIFTS = [
     (3, "شیفت 3", "00:00", "08:00"),
 ]
 
+# "شیفت 1 (08:00-16:00)" etc., built once instead of per message
+SHIFT_LABEL = {sid: f"{name} ({start}-{end})" for sid, name, start, end in SHIFTS}
+SHIFTS_BY_ID = {s[0]: s for s in SHIFTS}
+# Text the manager types in the shift picker -> shift_id
+SHIFT_ID_BY_TEXT = {str(sid): sid for sid in SHIFTS_BY_ID}
+BACK_TEXTS = frozenset({"⬅️ بازگشت", "⬅️ بازگشت به منوی اصلی"})
+
 REMINDER_MINUTES_BEFORE_SHIFT = 15
 LATE_ALERT_MINUTES_AFTER_SHIFT_START = 5
 
@@ -74,47 +115,172 @@ CHECKIN_LATE_MINUTES = 60
 CHECKOUT_EARLY_MINUTES = 5
 CHECKOUT_LATE_MINUTES = 60
 
-# =============================================================================
-# FLASK (Render keep-alive)
-# =============================================================================
-app = Flask(__name__)
-
-@app.get("/")
-def home():
-    return f"✅ {COMPANY_NAME} - Shift Bot is running!", 200
+log = logging.getLogger("npe-shift-bot")
 
 # =============================================================================
 # DATABASE
 # =============================================================================
+def configure_conn(conn: sqlite3.Connection):
+    # WAL lets readers run during a write; NORMAL is crash-safe under WAL
+    if DB_NAME != ":memory:":
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    # Reads come straight from the OS page cache instead of being copied into SQLite's
+    conn.execute("PRAGMA mmap_size=67108864")
+    return conn
+
+_CONN = None
+_LOCK = threading.RLock()
+
 def db():
-    return sqlite3.connect(DB_NAME)
+    # One long-lived connection keeps the page and statement caches warm
+    global _CONN
+    if _CONN is None:
+        _CONN = configure_conn(sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None))
+        _CONN.row_factory = sqlite3.Row
+    return _CONN
+
+_READ = threading.local()
+
+def read_db():
+    # Readers get their own connection per thread: WAL only lets a read proceed during a
+    # write when it isn't queued behind the writer's connection and _LOCK
+    conn = getattr(_READ, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only=ON")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=67108864")
+        _READ.conn = conn
+    return conn
+
+# Hot-path statements. sqlite3 caches prepared statements per connection keyed
+# by SQL text, so keeping these as constants guarantees cache hits on every
+# connection.
+_SQL_EMPLOYEE = "SELECT status, full_name FROM employees WHERE user_id=?"
+_SQL_EMPLOYEE_SHIFT = "SELECT shift_id FROM employee_shifts WHERE user_id=?"
+
+_SQL_TODAY_ATTENDANCE = """
+    SELECT id, shift_id, check_in_time, check_out_time, delay_minutes
+    FROM attendance WHERE date=? AND user_id=?
+    ORDER BY id DESC LIMIT 1
+"""
+
+_SQL_UPSERT_EMPLOYEE = """
+    INSERT INTO employees (user_id, telegram_username, full_name, status, created_at)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        telegram_username=excluded.telegram_username,
+        full_name=excluded.full_name,
+        status=excluded.status
+"""
+
+_SQL_SET_EMPLOYEE_STATUS = "UPDATE employees SET status=? WHERE user_id=?"
+
+_SQL_SET_EMPLOYEE_SHIFT = """
+    INSERT INTO employee_shifts (user_id, shift_id, updated_at)
+    VALUES (?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        shift_id=excluded.shift_id,
+        updated_at=excluded.updated_at
+"""
+
+# Duplicate check and insert in one statement: no row back = already checked in
+_SQL_CHECK_IN = """
+    INSERT INTO attendance (date, user_id, full_name, shift_id, check_in_time, delay_minutes)
+    SELECT ?, ?, ?, ?, ?, ?
+    WHERE NOT EXISTS (
+        SELECT 1 FROM attendance
+        WHERE user_id=? AND date=? AND check_in_time IS NOT NULL
+    )
+    RETURNING id
+"""
+
+_SQL_CHECK_OUT = """
+    UPDATE attendance SET check_out_time=?
+    WHERE id = (SELECT id FROM attendance WHERE date=? AND user_id=? ORDER BY id DESC LIMIT 1)
+      AND check_in_time IS NOT NULL AND check_out_time IS NULL
+    RETURNING id
+"""
+
+# Latest shift note and latest manager note for a day in one round trip, tagged by source
+_SQL_PREVIOUS_NOTES = """
+    SELECT * FROM (
+        SELECT 'note' AS src, full_name, shift_id, note FROM shift_notes
+        WHERE date=? ORDER BY id DESC LIMIT 1
+    )
+    UNION ALL
+    SELECT * FROM (
+        SELECT 'mgr', NULL, NULL, note FROM manager_notes
+        WHERE date=? ORDER BY id DESC LIMIT 1
+    )
+"""
+
+# Shift members with their names (reminder job) and those not checked in yet (late alert)
+_SQL_SHIFT_MEMBERS = """
+    SELECT es.user_id, e.full_name
+    FROM employee_shifts es LEFT JOIN employees e ON e.user_id = es.user_id
+    WHERE es.shift_id=?
+"""
+
+_SQL_LATE_MEMBERS = """
+    SELECT es.user_id, e.full_name
+    FROM employee_shifts es LEFT JOIN employees e ON e.user_id = es.user_id
+    WHERE es.shift_id=:shift AND NOT EXISTS (
+        SELECT 1 FROM attendance a
+        WHERE a.date=:date AND a.user_id=es.user_id AND a.shift_id=es.shift_id AND a.check_in_time IS NOT NULL
+    )
+"""
+
+# Daily (on demand) and nightly reports
+_SQL_REPORT_ATTENDANCE = """
+    SELECT full_name, shift_id, check_in_time, check_out_time, delay_minutes
+    FROM attendance
+    WHERE date=?
+    ORDER BY shift_id, full_name
+"""
+
+_SQL_REPORT_LEAVES = """
+    SELECT full_name, reason, status
+    FROM leave_requests
+    WHERE date=?
+    ORDER BY created_at DESC
+"""
+
+# Bump whenever the script below changes so existing databases pick it up
+SCHEMA_VERSION = 1
 
 def init_db():
-    conn = db()
-    c = conn.cursor()
+    with _LOCK:
+        if db().execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            _create_schema()
+        # Refresh planner stats for any index that needs it (cheap no-op otherwise)
+        db().execute("PRAGMA optimize")
 
-    # Employees
-    c.execute("""
+def _create_schema():
+    db().executescript(f"""
+        BEGIN;
+
+        -- Employees
         CREATE TABLE IF NOT EXISTS employees (
             user_id INTEGER PRIMARY KEY,
             telegram_username TEXT,
             full_name TEXT,
             status TEXT DEFAULT 'pending',
             created_at TEXT
-        )
-    """)
+        );
 
-    # Shift assignments (persistent)
-    c.execute("""
+        -- Shift assignments (persistent)
         CREATE TABLE IF NOT EXISTS employee_shifts (
             user_id INTEGER PRIMARY KEY,
             shift_id INTEGER,
             updated_at TEXT
-        )
-    """)
+        );
 
-    # Attendance (daily)
-    c.execute("""
+        -- Attendance (daily)
         CREATE TABLE IF NOT EXISTS attendance (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             date TEXT,
@@ -124,11 +290,9 @@ def init_db():
             check_in_time TEXT,
             check_out_time TEXT,
             delay_minutes INTEGER DEFAULT 0
-        )
-    """)
+        );
 
-    # Shift notes (handover)
-    c.execute("""
+        -- Shift notes (handover)
         CREATE TABLE IF NOT EXISTS shift_notes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             date TEXT,
@@ -137,21 +301,17 @@ def init_db():
             shift_id INTEGER,
             note TEXT,
             created_at TEXT
-        )
-    """)
+        );
 
-    # Manager announcements
-    c.execute("""
+        -- Manager announcements
         CREATE TABLE IF NOT EXISTS manager_notes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             date TEXT,
             note TEXT,
             created_at TEXT
-        )
-    """)
+        );
 
-    # Leave requests
-    c.execute("""
+        -- Leave requests
         CREATE TABLE IF NOT EXISTS leave_requests (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             date TEXT,
@@ -160,155 +320,310 @@ def init_db():
             reason TEXT,
             status TEXT DEFAULT 'pending',
             created_at TEXT
-        )
+        );
+
+        -- Hot lookups: today's attendance per user, latest note per day
+        CREATE INDEX IF NOT EXISTS idx_att_user_date ON attendance(user_id, date);
+        CREATE INDEX IF NOT EXISTS idx_shift_notes_date ON shift_notes(date, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_manager_notes_date ON manager_notes(date, id DESC);
+
+        -- Daily/nightly report and late-alert probe: filter on date, ordered by shift
+        -- then name; carries every column those queries read so no row lookups
+        CREATE INDEX IF NOT EXISTS idx_att_report ON attendance(
+            date, shift_id, full_name, user_id, check_in_time, check_out_time, delay_minutes
+        );
+        CREATE INDEX IF NOT EXISTS idx_leave_date ON leave_requests(date, created_at);
+
+        -- Reminder/late-alert jobs and the employee lists
+        CREATE INDEX IF NOT EXISTS idx_emp_shifts_shift ON employee_shifts(shift_id);
+        CREATE INDEX IF NOT EXISTS idx_employees_status ON employees(status);
+
+        PRAGMA user_version = {SCHEMA_VERSION};
+        COMMIT;
     """)
 
-    conn.commit()
-    conn.close()
+# =============================================================================
+# STORAGE WORKER (writes off the event loop)
+# =============================================================================
+class StorageWorker(threading.Thread):
+    """Runs queued write statements on a background thread so handlers never block on fsync."""
+
+    def __init__(self):
+        super().__init__(name="storage-worker", daemon=True)
+        self._queue = queue.SimpleQueue()
+
+    def submit(self, sql: str, params=()) -> Future:
+        fut = Future()
+        self._queue.put((sql, params, fut))
+        return fut
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # Skip writes whose awaiting coroutine was cancelled; the rest can no longer be cancelled
+            batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self._flush(batch)
+            except Exception as e:
+                # Never let one bad batch kill the thread: every later db_write would hang
+                log.exception("storage worker batch failed")
+                for _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+    def _flush(self, batch):
+        # Everything pending at dequeue time shares one transaction (one fsync)
+        with _LOCK:
+            conn = db()
+            results = []
+            try:
+                conn.execute("BEGIN")
+                for sql, run in groupby(batch, key=itemgetter(0)):
+                    results.extend(self._execute_run(conn, sql, [(params, fut) for _, params, fut in run]))
+                conn.execute("COMMIT")
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                results = [(fut, None, e) for _, _, fut in batch]
+        for fut, rows, err in results:
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(rows)
+
+    @staticmethod
+    def _execute_run(conn: sqlite3.Connection, sql: str, run):
+        # Consecutive writes of the same statement go through one executemany.
+        # RETURNING statements can't (executemany discards rows), and a failing
+        # run is retried row by row so only the bad item gets the error.
+        if len(run) > 1 and "RETURNING" not in sql.upper():
+            conn.execute("SAVEPOINT run")
+            try:
+                conn.executemany(sql, [params for params, _ in run])
+                conn.execute("RELEASE run")
+                return [(fut, [], None) for _, fut in run]
+            except sqlite3.Error:
+                conn.execute("ROLLBACK TO run")
+                conn.execute("RELEASE run")
+
+        out = []
+        for params, fut in run:
+            try:
+                out.append((fut, conn.execute(sql, params).fetchall(), None))
+            except sqlite3.Error as e:
+                out.append((fut, None, e))
+        return out
+
+storage = StorageWorker()
+
+async def db_write(sql: str, params=()):
+    return await asyncio.wrap_future(storage.submit(sql, params))
+
+def _fetch_all(sql: str, params):
+    return read_db().execute(sql, params).fetchall()
+
+async def db_read(sql: str, params=()):
+    # Runs on an executor thread with that thread's read connection
+    return await asyncio.to_thread(_fetch_all, sql, params)
+
+async def db_read_one(sql: str, params=()):
+    rows = await db_read(sql, params)
+    return rows[0] if rows else None
+
+_today_cache = (0.0, "", "")  # (epoch of next local midnight, today ISO, yesterday ISO)
+
+def _day_strings():
+    global _today_cache
+    now = time.time()
+    if now >= _today_cache[0]:
+        d = datetime.fromtimestamp(now).date()
+        midnight = datetime.combine(d + timedelta(days=1), dtime(0, 0))
+        _today_cache = (midnight.timestamp(), d.isoformat(), (d - timedelta(days=1)).isoformat())
+    return _today_cache
 
 def today_str():
-    return datetime.now().date().isoformat()
+    return _day_strings()[1]
 
-def parse_hhmm(hhmm: str) -> dtime:
-    h, m = hhmm.split(":")
-    return dtime(int(h), int(m))
+def yesterday_str():
+    return _day_strings()[2]
 
 def get_shift_by_id(shift_id: int):
-    for s in SHIFTS:
-        if s[0] == shift_id:
-            return s
-    return None
+    return SHIFTS_BY_ID.get(shift_id)
+
+# Per-user caches; each write drops only the affected user's entry
+_employee_cache = {}  # user_id -> (status, full_name) row, or None if not registered
+_shift_cache = {}     # user_id -> shift_id or None
+_cache_epoch = 0      # bumped on every invalidation so in-flight preloads can't store stale rows
+
+def _employee_row(user_id: int):
+    try:
+        return _employee_cache[user_id]
+    except KeyError:
+        pass
+    row = read_db().execute(_SQL_EMPLOYEE, (user_id,)).fetchone()
+    _employee_cache[user_id] = row
+    return row
 
 def get_employee_status(user_id: int):
     if user_id in ADMIN_USERS:
         return "approved"
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT status FROM employees WHERE user_id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else None
+    row = _employee_row(user_id)
+    return row["status"] if row else None
 
 def get_employee_full_name(user_id: int):
     if user_id in ADMIN_USERS:
         return None
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT full_name FROM employees WHERE user_id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else None
-
-def upsert_employee(user_id: int, username: str, full_name: str, status="pending"):
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO employees (user_id, telegram_username, full_name, status, created_at)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            telegram_username=excluded.telegram_username,
-            full_name=excluded.full_name,
-            status=excluded.status
-    """, (user_id, username, full_name, status, datetime.now().isoformat(timespec="seconds")))
-    conn.commit()
-    conn.close()
-
-def set_employee_status(user_id: int, status: str):
-    conn = db()
-    c = conn.cursor()
-    c.execute("UPDATE employees SET status=? WHERE user_id=?", (status, user_id))
-    conn.commit()
-    conn.close()
-
-def list_pending_employees():
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT user_id, telegram_username, full_name FROM employees WHERE status='pending'")
-    rows = c.fetchall()
-    conn.close()
+    row = _employee_row(user_id)
+    return row["full_name"] if row else None
+
+async def upsert_employee(user_id: int, username: str, full_name: str, status="pending"):
+    await db_write(_SQL_UPSERT_EMPLOYEE, (user_id, username, full_name, status, datetime.now().isoformat(timespec="seconds")))
+    invalidate_employee_cache(user_id)
+
+async def set_employee_status(user_id: int, status: str):
+    await db_write(_SQL_SET_EMPLOYEE_STATUS, (status, user_id))
+    invalidate_employee_cache(user_id)
+
+_employee_lists = {}  # status -> rows; every employee/shift write clears it
+
+def invalidate_employee_cache(user_id: int):
+    global _cache_epoch
+    _cache_epoch += 1
+    _employee_cache.pop(user_id, None)
+    _employee_lists.clear()
+
+async def _list_employees_by_status(status: str):
+    rows = _employee_lists.get(status)
+    if rows is not None:
+        return rows
+    epoch = _cache_epoch
+    rows = await db_read("""
+        SELECT e.user_id, e.telegram_username, e.full_name, es.shift_id
+        FROM employees e LEFT JOIN employee_shifts es ON es.user_id = e.user_id
+        WHERE e.status=?
+    """, (status,))
+    if epoch == _cache_epoch:
+        _employee_lists[status] = rows
     return rows
 
-def list_approved_employees():
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT user_id, telegram_username, full_name FROM employees WHERE status='approved'")
-    rows = c.fetchall()
-    conn.close()
-    return rows
+async def list_pending_employees():
+    return await _list_employees_by_status("pending")
 
-def set_employee_shift(user_id: int, shift_id: int):
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO employee_shifts (user_id, shift_id, updated_at)
-        VALUES (?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            shift_id=excluded.shift_id,
-            updated_at=excluded.updated_at
-    """, (user_id, shift_id, datetime.now().isoformat(timespec="seconds")))
-    conn.commit()
-    conn.close()
+async def list_approved_employees():
+    return await _list_employees_by_status("approved")
+
+async def set_employee_shift(user_id: int, shift_id: int):
+    global _cache_epoch
+    await db_write(_SQL_SET_EMPLOYEE_SHIFT, (user_id, shift_id, datetime.now().isoformat(timespec="seconds")))
+    _cache_epoch += 1
+    _shift_cache.pop(user_id, None)
+    _employee_lists.clear()
 
 def get_employee_shift(user_id: int):
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT shift_id FROM employee_shifts WHERE user_id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else None
-
-def shift_window_for_today(shift_id: int):
-    now = datetime.now()
-    shift = get_shift_by_id(shift_id)
-    if not shift:
-        return None, None
+    try:
+        return _shift_cache[user_id]
+    except KeyError:
+        pass
+    row = read_db().execute(_SQL_EMPLOYEE_SHIFT, (user_id,)).fetchone()
+    _shift_cache[user_id] = shift_id = row["shift_id"] if row else None
+    return shift_id
 
-    start_hhmm = shift[2]
-    end_hhmm = shift[3]
+async def preload_employee(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs before every handler: fill the caller's cache entries off the event loop so
+    # the sync getters above never hit SQLite on the loop thread for them.
+    user = update.effective_user
+    if not user:
+        return
+    uid = user.id
+    epoch = _cache_epoch
+    if uid not in _employee_cache:
+        row = await db_read_one(_SQL_EMPLOYEE, (uid,))
+        if epoch == _cache_epoch and uid not in _employee_cache:
+            _employee_cache[uid] = row
+    if uid not in _shift_cache:
+        row = await db_read_one(_SQL_EMPLOYEE_SHIFT, (uid,))
+        if epoch == _cache_epoch and uid not in _shift_cache:
+            _shift_cache[uid] = row["shift_id"] if row else None
+
+_report_cache = {}  # date -> rendered "today" report; dropped by any attendance/leave write
+_report_epoch = 0
+
+def invalidate_report():
+    global _report_epoch
+    _report_epoch += 1
+    _report_cache.clear()
+
+def _hhmm_minutes(hhmm: str) -> int:
+    h, m = hhmm.split(":")
+    return int(h) * 60 + int(m)
 
-    start_dt = datetime.combine(now.date(), parse_hhmm(start_hhmm))
-    if end_hhmm == "24:00":
-        end_dt = datetime.combine(now.date() + timedelta(days=1), dtime(0, 0))
-    else:
-        end_dt = datetime.combine(now.date(), parse_hhmm(end_hhmm))
+# shift_id -> (start, end) in minutes after today's midnight; "24:00" is simply 1440
+_SHIFT_MINUTES = {sid: (_hhmm_minutes(start), _hhmm_minutes(end)) for sid, _, start, end in SHIFTS}
+
+# Jobs are scheduled in the host's local time, same as datetime.now() everywhere else
+LOCAL_TZ = datetime.now().astimezone().tzinfo
 
-    return start_dt, end_dt
+def daily_time(hhmm: str, delta_minutes: int = 0) -> dtime:
+    # Wraps around midnight, e.g. 15 minutes before "00:00" is 23:45
+    minutes = (_hhmm_minutes(hhmm) + delta_minutes) % 1440
+    return dtime(minutes // 60, minutes % 60, tzinfo=LOCAL_TZ)
 
 # =============================================================================
 # KEYBOARDS
 # =============================================================================
+# Reply keyboards depend only on the user's role, so they are built once at import
+_EMPLOYEE_ROWS = [
+    [KeyboardButton("🕒 شیفت من"), KeyboardButton("✅ ثبت ورود"), KeyboardButton("❌ ثبت خروج")],
+    [KeyboardButton("✍️ توضیح برای شیفت بعد"), KeyboardButton("📜 توضیح شیفت قبلی")],
+    [KeyboardButton("🏖️ درخواست مرخصی"), KeyboardButton("📍 وضعیت امروز")],
+    [KeyboardButton("⬅️ بازگشت به منوی اصلی")],
+]
+
+KB_MAIN_ADMIN = ReplyKeyboardMarkup(
+    [[KeyboardButton("👨‍💼 پنل مدیر")], [KeyboardButton("👤 پنل کارمند")], [KeyboardButton("ℹ️ راهنما")]],
+    resize_keyboard=True,
+)
+KB_MAIN_USER = ReplyKeyboardMarkup(
+    [[KeyboardButton("👤 پنل کارمند")], [KeyboardButton("ℹ️ راهنما")]],
+    resize_keyboard=True,
+)
+KB_EMP_REGISTERED = ReplyKeyboardMarkup(_EMPLOYEE_ROWS, resize_keyboard=True)
+KB_EMP_UNREGISTERED = ReplyKeyboardMarkup([[KeyboardButton("📌 ثبت‌نام کارمند")]] + _EMPLOYEE_ROWS, resize_keyboard=True)
+KB_MANAGER = ReplyKeyboardMarkup([
+    [KeyboardButton("👥 تایید کارمندها"), KeyboardButton("🧾 لیست کارمندها")],
+    [KeyboardButton("🗓️ تعیین/تغییر شیفت"), KeyboardButton("📝 پیام مدیر")],
+    [KeyboardButton("📊 گزارش امروز"), KeyboardButton("🏖️ مرخصی‌ها")],
+    [KeyboardButton("⬅️ بازگشت به منوی اصلی")],
+], resize_keyboard=True)
+KB_BACK = ReplyKeyboardMarkup([[KeyboardButton("⬅️ بازگشت"), KeyboardButton("⬅️ بازگشت به منوی اصلی")]], resize_keyboard=True)
+KB_SHIFT_PICK = ReplyKeyboardMarkup(
+    [[KeyboardButton("1"), KeyboardButton("2"), KeyboardButton("3")],
+     [KeyboardButton("⬅️ بازگشت به منوی اصلی")]],
+    resize_keyboard=True
+)
+
 def kb_main(user_id: int):
-    buttons = []
-    if user_id in ADMIN_USERS:
-        buttons.append([KeyboardButton("👨‍💼 پنل مدیر")])
-    buttons.append([KeyboardButton("👤 پنل کارمند")])
-    buttons.append([KeyboardButton("ℹ️ راهنما")])
-    return ReplyKeyboardMarkup(buttons, resize_keyboard=True)
+    return KB_MAIN_ADMIN if user_id in ADMIN_USERS else KB_MAIN_USER
+
+_UNREGISTERED_STATUSES = frozenset({None, "pending"})
 
 def kb_employee(user_id: int):
-    rows = [
-        [KeyboardButton("🕒 شیفت من"), KeyboardButton("✅ ثبت ورود"), KeyboardButton("❌ ثبت خروج")],
-        [KeyboardButton("✍️ توضیح برای شیفت بعد"), KeyboardButton("📜 توضیح شیفت قبلی")],
-        [KeyboardButton("🏖️ درخواست مرخصی"), KeyboardButton("📍 وضعیت امروز")],
-        [KeyboardButton("⬅️ بازگشت به منوی اصلی")],
-    ]
-    status = get_employee_status(user_id)
-    if user_id not in ADMIN_USERS and status in (None, "pending"):
-        rows.insert(0, [KeyboardButton("📌 ثبت‌نام کارمند")])
-    return ReplyKeyboardMarkup(rows, resize_keyboard=True)
+    if user_id not in ADMIN_USERS and get_employee_status(user_id) in _UNREGISTERED_STATUSES:
+        return KB_EMP_UNREGISTERED
+    return KB_EMP_REGISTERED
 
 def kb_manager(user_id: int):
-    role = "سوپر یوزر" if user_id in SUPERUSER else "مدیر"
-    rows = [
-        [KeyboardButton("👥 تایید کارمندها"), KeyboardButton("🧾 لیست کارمندها")],
-        [KeyboardButton("🗓️ تعیین/تغییر شیفت"), KeyboardButton("📝 پیام مدیر")],
-        [KeyboardButton("📊 گزارش امروز"), KeyboardButton("🏖️ مرخصی‌ها")],
-        [KeyboardButton("⬅️ بازگشت به منوی اصلی")],
-    ]
-    return ReplyKeyboardMarkup(rows, resize_keyboard=True)
+    return KB_MANAGER
 
 def kb_back():
-    return ReplyKeyboardMarkup([[KeyboardButton("⬅️ بازگشت"), KeyboardButton("⬅️ بازگشت به منوی اصلی")]], resize_keyboard=True)
+    return KB_BACK
 
 def ikb_approve_reject(emp_id: int):
     return InlineKeyboardMarkup([
@@ -318,6 +633,15 @@ def ikb_approve_reject(emp_id: int):
         ]
     ])
 
+def ikb_pending_page(emps):
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton(f"✅ {emp['full_name']}", callback_data=f"approve:{emp['user_id']}"),
+            InlineKeyboardButton("❌", callback_data=f"reject:{emp['user_id']}")
+        ]
+        for emp in emps
+    ])
+
 def ikb_leave(req_id: int):
     return InlineKeyboardMarkup([
         [
@@ -357,6 +681,14 @@ REMINDER_TEXT = (
     "موفق باشید 🌿"
 )
 
+# Everything but the name is fixed per shift: split each shift's reminder around it once
+REMINDER_PARTS = {
+    sid: tuple(REMINDER_TEXT.format(
+        name="\0", minutes=REMINDER_MINUTES_BEFORE_SHIFT, shift_name=name, start=start, end=end,
+    ).split("\0"))
+    for sid, name, start, end in SHIFTS
+}
+
 LATE_ALERT_TEXT = (
     f"⚠️ هشدار عدم ثبت ورود | {COMPANY_NAME}\n\n"
     "برای شیفت {shift_name} تا {late} دقیقه بعد از شروع شیفت، هنوز ورود ثبت نشده برای:\n"
@@ -364,15 +696,113 @@ LATE_ALERT_TEXT = (
     "لطفاً بررسی شود."
 )
 
+# Manager/employee notification scaffolds, filled with str.format at the call site
+NOTIFY_REGISTER_TEXT = "👤 درخواست ثبت‌نام\n\nنام: {name}\nID: {uid}{username}\n\n✅ تایید / ❌ رد ؟"
+NOTIFY_CHECKIN_TEXT = "📌 ثبت ورود\n\n👤 {name}\n🗓️ {date}\n🕒 {shift}\n⏱️ تاخیر: {delay} دقیقه"
+NOTIFY_CHECKOUT_TEXT = "✅ ثبت خروج\n\n👤 {name}\n🗓️ {date}\n🕒 ساعت: {time}"
+NOTIFY_NOTE_TEXT = "📝 توضیح شیفت بعد\n\n👤 {name}\n🗓️ {date}\n\n{note}"
+NOTIFY_LEAVE_TEXT = "🏖️ درخواست مرخصی\n\n👤 {name}\n🗓️ {date}\n\n📌 دلیل:\n{reason}"
+SHIFT_ASSIGNED_TEXT = "📌 شیفت شما تنظیم شد:\n\n{shift} ✅"
+
 # =============================================================================
 # HELPERS
 # =============================================================================
-async def notify_real_managers(context: ContextTypes.DEFAULT_TYPE, text: str):
-    for mid in REAL_MANAGERS | SUPERUSER:
+SEND_LIMITER = AsyncLimiter(SEND_RATE_PER_SECOND, 1)
+
+def _utf16_len(s: str) -> int:
+    return len(s.encode("utf-16-le")) // 2
+
+def _utf16_prefix(s: str, limit: int) -> int:
+    # How many code points of s fit in limit UTF-16 units, never splitting a surrogate pair
+    units = 0
+    for i, ch in enumerate(s):
+        units += 2 if ord(ch) > 0xFFFF else 1
+        if units > limit:
+            return i
+    return len(s)
+
+def split_message(text: str, limit: int = MESSAGE_MAX_LENGTH):
+    """Cut text into parts Telegram will accept, on line boundaries where possible."""
+    if _utf16_len(text) <= limit:
+        return [text]
+    parts, buf, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        n = _utf16_len(line)
+        if buf and size + n > limit:
+            parts.append("".join(buf))
+            buf, size = [], 0
+        while n > limit:
+            cut = _utf16_prefix(line, limit)
+            parts.append(line[:cut])
+            line = line[cut:]
+            n = _utf16_len(line)
+        buf.append(line)
+        size += n
+    if buf:
+        parts.append("".join(buf))
+    # Telegram rejects whitespace-only messages, e.g. the lone "\n" left after a full-length line
+    return [p for p in parts if p.strip()] or parts[:1]
+
+async def reply_long(message, text: str, reply_markup=None):
+    # Parts go out in order; only the last carries the keyboard
+    *head, last = split_message(text)
+    for part in head:
+        await message.reply_text(part)
+    return await message.reply_text(last, reply_markup=reply_markup)
+
+# Chats that blocked the bot; skipped until the user writes to us again
+_dead_chats = set()
+
+async def safe_send(bot, **kwargs):
+    """send_message under the global rate limit; waits out flood control, logs other failures."""
+    chat_id = kwargs.get("chat_id")
+    if chat_id in _dead_chats:
+        return None
+    for attempt in range(SEND_RETRIES):
+        async with SEND_LIMITER:
+            try:
+                return await bot.send_message(**kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+            except Forbidden as e:
+                _dead_chats.add(chat_id)
+                log.warning("send to %s forbidden, muting until they return: %r", chat_id, e)
+                return None
+            except TelegramError as e:
+                log.warning("send to %s failed: %r", chat_id, e)
+                return None
+        await asyncio.sleep(retry_after)
+    log.warning("send to %s dropped after %d flood waits", chat_id, SEND_RETRIES)
+    return None
+
+async def revive_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        _dead_chats.discard(update.effective_user.id)
+
+# Fire-and-forget sends: handlers and jobs enqueue, send_worker tasks deliver
+_send_queue = asyncio.Queue()
+
+def enqueue_send(bot, **kwargs):
+    # A long text becomes several messages in one queue item, so a single worker sends them in order
+    reply_markup = kwargs.pop("reply_markup", None)
+    messages = [dict(kwargs, text=part) for part in split_message(kwargs.pop("text"))]
+    messages[-1]["reply_markup"] = reply_markup
+    _send_queue.put_nowait((bot, messages))
+
+async def send_worker():
+    while True:
+        bot, messages = await _send_queue.get()
         try:
-            await context.bot.send_message(chat_id=mid, text=text)
-        except:
-            pass
+            for kwargs in messages:
+                await safe_send(bot, **kwargs)
+        except Exception as e:
+            log.exception("send worker error: %r", e)
+        finally:
+            _send_queue.task_done()
+
+def notify_real_managers(context: ContextTypes.DEFAULT_TYPE, text: str, reply_markup=None):
+    for mid in ADMIN_USERS:
+        enqueue_send(context.bot, chat_id=mid, text=text, reply_markup=reply_markup)
 
 async def must_be_employee(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
@@ -426,24 +856,18 @@ async def register_employee_save(update: Update, context: ContextTypes.DEFAULT_T
     uid = update.effective_user.id
     txt = update.message.text.strip()
 
-    if txt in ["⬅️ بازگشت", "⬅️ بازگشت به منوی اصلی"]:
+    if txt in BACK_TEXTS:
         await start(update, context)
         return ConversationHandler.END
 
-    upsert_employee(uid, update.effective_user.username or "", txt, "pending")
+    await upsert_employee(uid, update.effective_user.username or "", txt, "pending")
 
     await update.message.reply_text("✅ ثبت شد. منتظر تایید مدیر باشید.", reply_markup=kb_employee(uid))
 
-    msg = f"👤 درخواست ثبت‌نام\n\nنام: {txt}\nID: {uid}"
-    if update.effective_user.username:
-        msg += f"\n@{update.effective_user.username}"
-    msg += "\n\n✅ تایید / ❌ رد ؟"
+    username = update.effective_user.username
+    msg = NOTIFY_REGISTER_TEXT.format(name=txt, uid=uid, username=f"\n@{username}" if username else "")
 
-    for mid in ADMIN_USERS:
-        try:
-            await context.bot.send_message(chat_id=mid, text=msg, reply_markup=ikb_approve_reject(uid))
-        except:
-            pass
+    notify_real_managers(context, msg, reply_markup=ikb_approve_reject(uid))
 
     return ConversationHandler.END
 
@@ -455,39 +879,45 @@ async def approve_reject_callback(update: Update, context: ContextTypes.DEFAULT_
         await q.edit_message_text("❌ فقط مدیر اجازه دارد.")
         return
 
-    action, emp_id_str = q.data.split(":")
+    action, _, emp_id_str = q.data.partition(":")
     emp_id = int(emp_id_str)
 
     if action == "approve":
-        set_employee_status(emp_id, "approved")
-        await q.edit_message_text("✅ تایید شد.")
-        try:
-            await context.bot.send_message(chat_id=emp_id, text=f"✅ حساب شما در {COMPANY_NAME} تایید شد. خوش آمدید 🌟")
-        except:
-            pass
+        await set_employee_status(emp_id, "approved")
+        await resolve_approval(q, emp_id, "✅ تایید شد.")
+        enqueue_send(context.bot, chat_id=emp_id, text=f"✅ حساب شما در {COMPANY_NAME} تایید شد. خوش آمدید 🌟")
 
     elif action == "reject":
-        set_employee_status(emp_id, "rejected")
-        await q.edit_message_text("❌ رد شد.")
-        try:
-            await context.bot.send_message(chat_id=emp_id, text="❌ درخواست شما رد شد.")
-        except:
-            pass
+        await set_employee_status(emp_id, "rejected")
+        await resolve_approval(q, emp_id, "❌ رد شد.")
+        enqueue_send(context.bot, chat_id=emp_id, text="❌ درخواست شما رد شد.")
+
+async def resolve_approval(q, emp_id: int, result: str):
+    # Pending-list pages hold one button row per employee: re-render the page with whoever on it
+    # is still pending. Single cards (and messages we can no longer read) just show the result.
+    markup = getattr(q.message, "reply_markup", None)
+    if markup is None or len(markup.inline_keyboard) <= 1:
+        await q.edit_message_text(result)
+        return
+    page_ids = {int(row[0].callback_data.partition(":")[2]) for row in markup.inline_keyboard}
+    page = [emp for emp in await list_pending_employees() if emp["user_id"] in page_ids]
+    if not page:
+        await q.edit_message_text(result)
+        return
+    await q.edit_message_text(
+        "".join(f"{employee_line(emp)}\n" for emp in page),
+        reply_markup=ikb_pending_page(page),
+    )
 
 # =============================================================================
 # EMPLOYEE FEATURES
 # =============================================================================
-def get_today_attendance(user_id: int, date_str: str):
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, shift_id, check_in_time, check_out_time, delay_minutes
-        FROM attendance WHERE date=? AND user_id=?
-        ORDER BY id DESC LIMIT 1
-    """, (date_str, user_id))
-    row = c.fetchone()
-    conn.close()
-    return row
+async def get_today_attendance(user_id: int, date_str: str):
+    return await db_read_one(_SQL_TODAY_ATTENDANCE, (date_str, user_id))
+
+async def previous_notes(day: str):
+    notes = {row["src"]: row for row in await db_read(_SQL_PREVIOUS_NOTES, (day, day))}
+    return notes.get("note"), notes.get("mgr")
 
 async def my_shift(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await must_be_employee(update, context):
@@ -501,16 +931,9 @@ async def my_shift(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     s = get_shift_by_id(shift_id)
-    yday = (datetime.now().date() - timedelta(days=1)).isoformat()
-
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT full_name, note FROM shift_notes WHERE date=? ORDER BY id DESC LIMIT 1", (yday,))
-    prev_note = c.fetchone()
+    yday = yesterday_str()
 
-    c.execute("SELECT note FROM manager_notes WHERE date=? ORDER BY id DESC LIMIT 1", (yday,))
-    mgr_note = c.fetchone()
-    conn.close()
+    prev_note, mgr_note = await previous_notes(yday)
 
     text = (
         f"🕒 شیفت شما | {COMPANY_NAME}\n\n"
@@ -520,14 +943,14 @@ async def my_shift(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     text += "📜 توضیح شیفت قبلی:\n"
     if prev_note:
-        text += f"👤 {prev_note[0]}\n{prev_note[1]}\n\n"
+        text += f"👤 {prev_note['full_name']}\n{prev_note['note']}\n\n"
     else:
         text += "— موردی ثبت نشده.\n\n"
 
     text += "📝 پیام مدیر:\n"
-    text += mgr_note[0] if mgr_note else "— پیامی ثبت نشده."
+    text += mgr_note["note"] if mgr_note else "— پیامی ثبت نشده."
 
-    await update.message.reply_text(text, reply_markup=kb_employee(uid))
+    await reply_long(update.message, text, reply_markup=kb_employee(uid))
 
 async def employee_check_in(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await must_be_employee(update, context):
@@ -535,20 +958,18 @@ async def employee_check_in(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user = update.effective_user
     uid = user.id
-    date_str = today_str()
+    now = datetime.now()
+    date_str = now.date().isoformat()
     shift_id = get_employee_shift(uid)
 
     if not shift_id:
         await update.message.reply_text("❌ شیفت شما هنوز تنظیم نشده. با مدیر تماس بگیرید.", reply_markup=kb_employee(uid))
         return
 
-    shift_start_dt, shift_end_dt = shift_window_for_today(shift_id)
-    now = datetime.now()
+    # Minutes since today's shift start; negative before it
+    minutes_in = now.hour * 60 + now.minute - _SHIFT_MINUTES[shift_id][0]
 
-    allowed_start = shift_start_dt - timedelta(minutes=CHECKIN_EARLY_MINUTES)
-    allowed_end = shift_start_dt + timedelta(minutes=CHECKIN_LATE_MINUTES)
-
-    if now < allowed_start:
+    if minutes_in < -CHECKIN_EARLY_MINUTES:
         await update.message.reply_text(
             f"⛔ هنوز زمان ورود شما نرسیده.\n\n"
             f"✅ ورود فقط از *{CHECKIN_EARLY_MINUTES} دقیقه قبل شروع شیفت* مجاز است.",
@@ -557,7 +978,7 @@ async def employee_check_in(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if now > allowed_end:
+    if minutes_in > CHECKIN_LATE_MINUTES:
         await update.message.reply_text(
             f"⛔ زمان ورود شما گذشته.\n\n"
             f"✅ ورود فقط تا *{CHECKIN_LATE_MINUTES} دقیقه بعد از شروع شیفت* مجاز است.",
@@ -566,62 +987,46 @@ async def employee_check_in(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    existing = get_today_attendance(uid, date_str)
-    if existing and existing[2]:
-        await update.message.reply_text("✅ ورود شما قبلاً ثبت شده است.", reply_markup=kb_employee(uid))
-        return
-
     shift = get_shift_by_id(shift_id)
-    delay = max(0, int((now - shift_start_dt).total_seconds() // 60))
+    delay = max(0, minutes_in)
 
     full_name = get_employee_full_name(uid) or user.full_name
 
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO attendance (date, user_id, full_name, shift_id, check_in_time, delay_minutes)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (date_str, uid, full_name, shift_id, now.isoformat(timespec="seconds"), delay))
-    conn.commit()
-    conn.close()
+    inserted = await db_write(_SQL_CHECK_IN, (date_str, uid, full_name, shift_id, now.isoformat(timespec="seconds"), delay, uid, date_str))
+
+    if not inserted:
+        await update.message.reply_text("✅ ورود شما قبلاً ثبت شده است.", reply_markup=kb_employee(uid))
+        return
+    invalidate_report()
 
     await update.message.reply_text(
         f"✅ ورود ثبت شد!\n\n"
         f"👤 {full_name}\n"
-        f"🕒 {shift[1]} ({shift[2]}-{shift[3]})\n"
+        f"🕒 {SHIFT_LABEL[shift_id]}\n"
         f"⏱️ تاخیر: {delay} دقیقه",
         reply_markup=kb_employee(uid)
     )
 
-    await notify_real_managers(context, f"📌 ثبت ورود\n\n👤 {full_name}\n🗓️ {date_str}\n🕒 {shift[1]}\n⏱️ تاخیر: {delay} دقیقه")
+    notify_real_managers(context, NOTIFY_CHECKIN_TEXT.format(name=full_name, date=date_str, shift=shift[1], delay=delay))
 
 async def employee_check_out(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await must_be_employee(update, context):
         return
 
     uid = update.effective_user.id
-    date_str = today_str()
-
-    row = get_today_attendance(uid, date_str)
-    if not row or not row[2]:
-        await update.message.reply_text("❌ هنوز ورود ثبت نکرده‌اید.", reply_markup=kb_employee(uid))
-        return
-    if row[3]:
-        await update.message.reply_text("✅ خروج شما قبلاً ثبت شده است.", reply_markup=kb_employee(uid))
-        return
+    now = datetime.now()
+    now_iso = now.isoformat(timespec="seconds")
+    date_str = now_iso[:10]
 
     shift_id = get_employee_shift(uid)
     if not shift_id:
         await update.message.reply_text("❌ شیفت شما مشخص نیست. با مدیر تماس بگیرید.", reply_markup=kb_employee(uid))
         return
 
-    shift_start_dt, shift_end_dt = shift_window_for_today(shift_id)
-    now = datetime.now()
-
-    allowed_start = shift_end_dt - timedelta(minutes=CHECKOUT_EARLY_MINUTES)
-    allowed_end = shift_end_dt + timedelta(minutes=CHECKOUT_LATE_MINUTES)
+    # Minutes since today's shift end; negative before it
+    minutes_out = now.hour * 60 + now.minute - _SHIFT_MINUTES[shift_id][1]
 
-    if now < allowed_start:
+    if minutes_out < -CHECKOUT_EARLY_MINUTES:
         await update.message.reply_text(
             f"⛔ هنوز زمان خروج شما نرسیده.\n\n"
             f"✅ خروج فقط از *{CHECKOUT_EARLY_MINUTES} دقیقه قبل پایان شیفت* مجاز است.",
@@ -630,7 +1035,7 @@ async def employee_check_out(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
 
-    if now > allowed_end:
+    if minutes_out > CHECKOUT_LATE_MINUTES:
         await update.message.reply_text(
             f"⛔ زمان خروج شما گذشته.\n\n"
             f"✅ خروج فقط تا *{CHECKOUT_LATE_MINUTES} دقیقه بعد پایان شیفت* مجاز است.",
@@ -639,15 +1044,21 @@ async def employee_check_out(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
 
-    conn = db()
-    c = conn.cursor()
-    c.execute("UPDATE attendance SET check_out_time=? WHERE id=?", (now.isoformat(timespec="seconds"), row[0]))
-    conn.commit()
-    conn.close()
+    updated = await db_write(_SQL_CHECK_OUT, (now_iso, date_str, uid))
+
+    if not updated:
+        # Only the failure path pays for the extra read to pick the right message
+        row = await get_today_attendance(uid, date_str)
+        if not row or not row["check_in_time"]:
+            await update.message.reply_text("❌ هنوز ورود ثبت نکرده‌اید.", reply_markup=kb_employee(uid))
+        else:
+            await update.message.reply_text("✅ خروج شما قبلاً ثبت شده است.", reply_markup=kb_employee(uid))
+        return
+    invalidate_report()
 
     full_name = get_employee_full_name(uid) or update.effective_user.full_name
     await update.message.reply_text("✅ خروج ثبت شد. خسته نباشی 🌟", reply_markup=kb_employee(uid))
-    await notify_real_managers(context, f"✅ ثبت خروج\n\n👤 {full_name}\n🗓️ {date_str}\n🕒 ساعت: {now.strftime('%H:%M')}")
+    notify_real_managers(context, NOTIFY_CHECKOUT_TEXT.format(name=full_name, date=date_str, time=now_iso[11:16]))
 
 async def employee_status_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await must_be_employee(update, context):
@@ -656,19 +1067,18 @@ async def employee_status_today(update: Update, context: ContextTypes.DEFAULT_TY
     uid = update.effective_user.id
     date_str = today_str()
     shift_id = get_employee_shift(uid)
-    att = get_today_attendance(uid, date_str)
+    att = await get_today_attendance(uid, date_str)
 
     text = f"📍 وضعیت امروز ({date_str})\n\n"
     if shift_id:
-        s = get_shift_by_id(shift_id)
-        text += f"🕒 شیفت: {s[1]} ({s[2]}-{s[3]})\n\n"
+        text += f"🕒 شیفت: {SHIFT_LABEL[shift_id]}\n\n"
     else:
         text += "🕒 شیفت: تعیین نشده\n\n"
 
     if att:
-        text += f"✅ ورود: {att[2]}\n"
-        text += f"❌ خروج: {att[3] or 'ثبت نشده'}\n"
-        text += f"⏱️ تاخیر: {att[4]} دقیقه\n"
+        text += f"✅ ورود: {att['check_in_time']}\n"
+        text += f"❌ خروج: {att['check_out_time'] or 'ثبت نشده'}\n"
+        text += f"⏱️ تاخیر: {att['delay_minutes']} دقیقه\n"
     else:
         text += "❌ ورود ثبت نشده.\n"
 
@@ -687,25 +1097,22 @@ async def employee_note_save(update: Update, context: ContextTypes.DEFAULT_TYPE)
     uid = update.effective_user.id
     txt = update.message.text.strip()
 
-    if txt in ["⬅️ بازگشت", "⬅️ بازگشت به منوی اصلی"]:
+    if txt in BACK_TEXTS:
         await start(update, context)
         return ConversationHandler.END
 
-    date_str = today_str()
+    now_iso = datetime.now().isoformat(timespec="seconds")
+    date_str = now_iso[:10]
     shift_id = get_employee_shift(uid) or 0
     full_name = get_employee_full_name(uid) or update.effective_user.full_name
 
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
+    await db_write("""
         INSERT INTO shift_notes (date, user_id, full_name, shift_id, note, created_at)
         VALUES (?, ?, ?, ?, ?, ?)
-    """, (date_str, uid, full_name, shift_id, txt, datetime.now().isoformat(timespec="seconds")))
-    conn.commit()
-    conn.close()
+    """, (date_str, uid, full_name, shift_id, txt, now_iso))
 
     await update.message.reply_text("✅ توضیح ثبت شد و به مدیر ارسال شد.", reply_markup=kb_employee(uid))
-    await notify_real_managers(context, f"📝 توضیح شیفت بعد\n\n👤 {full_name}\n🗓️ {date_str}\n\n{txt}")
+    notify_real_managers(context, NOTIFY_NOTE_TEXT.format(name=full_name, date=date_str, note=txt))
 
     return ConversationHandler.END
 
@@ -713,38 +1120,20 @@ async def previous_shift_notes(update: Update, context: ContextTypes.DEFAULT_TYP
     if not await must_be_employee(update, context):
         return
 
-    yday = (datetime.now().date() - timedelta(days=1)).isoformat()
+    yday = yesterday_str()
 
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT full_name, shift_id, note
-        FROM shift_notes
-        WHERE date=?
-        ORDER BY id DESC LIMIT 1
-    """, (yday,))
-    row = c.fetchone()
-
-    c.execute("""
-        SELECT note
-        FROM manager_notes
-        WHERE date=?
-        ORDER BY id DESC LIMIT 1
-    """, (yday,))
-    mgr = c.fetchone()
-
-    conn.close()
+    row, mgr = await previous_notes(yday)
 
     text = "📜 توضیحات شیفت قبلی:\n\n"
     if row:
-        text += f"👤 {row[0]} | شیفت {row[1]}\n\n{row[2]}\n\n"
+        text += f"👤 {row['full_name']} | شیفت {row['shift_id']}\n\n{row['note']}\n\n"
     else:
         text += "— موردی ثبت نشده.\n\n"
 
     text += "📝 پیام مدیر:\n\n"
-    text += mgr[0] if mgr else "— پیامی ثبت نشده."
+    text += mgr["note"] if mgr else "— پیامی ثبت نشده."
 
-    await update.message.reply_text(text, reply_markup=kb_employee(update.effective_user.id))
+    await reply_long(update.message, text, reply_markup=kb_employee(update.effective_user.id))
 
 # =============================================================================
 # Leave
@@ -759,35 +1148,32 @@ async def leave_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     txt = update.message.text.strip()
 
-    if txt in ["⬅️ بازگشت", "⬅️ بازگشت به منوی اصلی"]:
+    if txt in BACK_TEXTS:
         await start(update, context)
         return ConversationHandler.END
 
-    date_str = today_str()
+    now_iso = datetime.now().isoformat(timespec="seconds")
+    date_str = now_iso[:10]
     full_name = get_employee_full_name(uid) or update.effective_user.full_name
 
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
+    rows = await db_write("""
         INSERT INTO leave_requests (date, user_id, full_name, reason, status, created_at)
         VALUES (?, ?, ?, ?, 'pending', ?)
-    """, (date_str, uid, full_name, txt, datetime.now().isoformat(timespec="seconds")))
-    req_id = c.lastrowid
-    conn.commit()
-    conn.close()
+        RETURNING id
+    """, (date_str, uid, full_name, txt, now_iso))
+    req_id = rows[0]["id"]
+    invalidate_report()
 
     await update.message.reply_text("✅ درخواست مرخصی ثبت شد و به مدیر ارسال شد.", reply_markup=kb_employee(uid))
 
-    msg = f"🏖️ درخواست مرخصی\n\n👤 {full_name}\n🗓️ {date_str}\n\n📌 دلیل:\n{txt}"
+    msg = NOTIFY_LEAVE_TEXT.format(name=full_name, date=date_str, reason=txt)
 
-    for mid in ADMIN_USERS:
-        try:
-            await context.bot.send_message(chat_id=mid, text=msg, reply_markup=ikb_leave(req_id))
-        except:
-            pass
+    notify_real_managers(context, msg, reply_markup=ikb_leave(req_id))
 
     return ConversationHandler.END
 
+LEAVE_ACTIONS = {"leave_approve": "approved", "leave_reject": "rejected"}
+
 async def leave_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
@@ -796,39 +1182,27 @@ async def leave_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.edit_message_text("❌ فقط مدیر اجازه دارد.")
         return
 
-    action, req_id_str = q.data.split(":")
+    action, _, req_id_str = q.data.partition(":")
     req_id = int(req_id_str)
 
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT user_id, full_name, date FROM leave_requests WHERE id=?", (req_id,))
-    row = c.fetchone()
-    if not row:
-        conn.close()
+    status = LEAVE_ACTIONS.get(action)
+    if not status:
+        return
+
+    rows = await db_write("UPDATE leave_requests SET status=? WHERE id=? RETURNING user_id, date", (status, req_id))
+    if not rows:
         await q.edit_message_text("❌ درخواست پیدا نشد.")
         return
+    invalidate_report()
 
-    emp_id, full_name, date_str = row
+    emp_id, date_str = rows[0]["user_id"], rows[0]["date"]
 
-    if action == "leave_approve":
-        c.execute("UPDATE leave_requests SET status='approved' WHERE id=?", (req_id,))
-        conn.commit()
-        conn.close()
+    if status == "approved":
         await q.edit_message_text("✅ مرخصی تایید شد.")
-        try:
-            await context.bot.send_message(chat_id=emp_id, text=f"✅ مرخصی شما برای {date_str} تایید شد.")
-        except:
-            pass
-
-    elif action == "leave_reject":
-        c.execute("UPDATE leave_requests SET status='rejected' WHERE id=?", (req_id,))
-        conn.commit()
-        conn.close()
+        enqueue_send(context.bot, chat_id=emp_id, text=f"✅ مرخصی شما برای {date_str} تایید شد.")
+    else:
         await q.edit_message_text("❌ مرخصی رد شد.")
-        try:
-            await context.bot.send_message(chat_id=emp_id, text=f"❌ مرخصی شما برای {date_str} رد شد.")
-        except:
-            pass
+        enqueue_send(context.bot, chat_id=emp_id, text=f"❌ مرخصی شما برای {date_str} رد شد.")
 
 # =============================================================================
 # Manager features
@@ -837,39 +1211,39 @@ async def manager_pending_employees(update: Update, context: ContextTypes.DEFAUL
     if update.effective_user.id not in ADMIN_USERS:
         return
 
-    pendings = list_pending_employees()
+    pendings = await list_pending_employees()
     if not pendings:
         await update.message.reply_text("✅ هیچ درخواست در انتظار تایید نداریم.", reply_markup=kb_manager(update.effective_user.id))
         return
 
     await update.message.reply_text("🔔 درخواست‌های در انتظار تایید:", reply_markup=kb_manager(update.effective_user.id))
-    for emp_id, username, full_name in pendings:
-        msg = f"👤 {full_name}\nID: {emp_id}"
-        if username:
-            msg += f"\n@{username}"
-        await update.message.reply_text(msg, reply_markup=ikb_approve_reject(emp_id))
+    for i in range(0, len(pendings), PENDING_PAGE_SIZE):
+        page = pendings[i:i + PENDING_PAGE_SIZE]
+        await update.message.reply_text(
+            "".join(f"{employee_line(emp)}\n" for emp in page),
+            reply_markup=ikb_pending_page(page),
+        )
+
+def employee_line(emp):
+    line = f"• {emp['full_name']} | ID: {emp['user_id']}"
+    if emp["telegram_username"]:
+        line += f" | @{emp['telegram_username']}"
+    if emp["shift_id"]:
+        line += f" | {SHIFT_LABEL[emp['shift_id']]}"
+    return line
 
 async def list_employees(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_USERS:
         return
 
-    emps = list_approved_employees()
+    emps = await list_approved_employees()
     if not emps:
         await update.message.reply_text("❌ هنوز کارمندی تایید نشده.", reply_markup=kb_manager(update.effective_user.id))
         return
 
-    text = "🧾 لیست کارمندهای تایید شده:\n\n"
-    for uid, username, full_name in emps:
-        text += f"• {full_name} | ID: {uid}"
-        if username:
-            text += f" | @{username}"
-        shift_id = get_employee_shift(uid)
-        if shift_id:
-            s = get_shift_by_id(shift_id)
-            text += f" | {s[1]} ({s[2]}-{s[3]})"
-        text += "\n"
+    text = "🧾 لیست کارمندهای تایید شده:\n\n" + "".join(f"{employee_line(emp)}\n" for emp in emps)
 
-    await update.message.reply_text(text, reply_markup=kb_manager(update.effective_user.id))
+    await reply_long(update.message, text, reply_markup=kb_manager(update.effective_user.id))
 
 # =============================================================================
 # Shift assignment persistent
@@ -878,34 +1252,36 @@ async def assign_shift_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if update.effective_user.id not in ADMIN_USERS:
         return ConversationHandler.END
 
-    emps = list_approved_employees()
+    emps = await list_approved_employees()
     if not emps:
         await update.message.reply_text("❌ کارمندی تایید نشده.", reply_markup=kb_manager(update.effective_user.id))
         return ConversationHandler.END
 
-    text = "🗓️ تعیین/تغییر شیفت کارمند\n\nیک کارمند را با ID ارسال کن:\n\n"
-    for uid, username, full_name in emps:
-        text += f"• {full_name} | ID: {uid}\n"
-    text += "\n(مثلاً: 123456789)\n\n⬅️ بازگشت: /cancel"
+    text = (
+        "🗓️ تعیین/تغییر شیفت کارمند\n\nیک کارمند را با ID ارسال کن:\n\n"
+        + "".join(f"• {emp['full_name']} | ID: {emp['user_id']}\n" for emp in emps)
+        + "\n(مثلاً: 123456789)\n\n⬅️ بازگشت: /cancel"
+    )
 
-    await update.message.reply_text(text, reply_markup=kb_manager(update.effective_user.id))
+    await reply_long(update.message, text, reply_markup=kb_manager(update.effective_user.id))
     return ASSIGN_SHIFT_USER
 
+def parse_user_id(txt: str):
+    # Telegram ids fit in 52 bits (<= 16 digits), well inside SQLite's INTEGER. isdecimal() is exactly
+    # what int() accepts, so Persian digits still work but "²" and million-digit input are rejected.
+    if txt.isdecimal() and len(txt) <= 16:
+        return int(txt)
+    return None
+
 async def assign_shift_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    txt = update.message.text.strip()
-    if not txt.isdigit():
+    emp_id = parse_user_id(update.message.text.strip())
+    if emp_id is None:
         await update.message.reply_text("❌ لطفاً فقط ID عددی بفرست.", reply_markup=kb_manager(update.effective_user.id))
         return ASSIGN_SHIFT_USER
 
-    context.user_data["assign_user_id"] = int(txt)
+    context.user_data["assign_user_id"] = emp_id
 
-    kb = ReplyKeyboardMarkup(
-        [[KeyboardButton("1"), KeyboardButton("2"), KeyboardButton("3")],
-         [KeyboardButton("⬅️ بازگشت به منوی اصلی")]],
-        resize_keyboard=True
-    )
-
-    await update.message.reply_text("شماره شیفت را انتخاب کن (1/2/3):", reply_markup=kb)
+    await update.message.reply_text("شماره شیفت را انتخاب کن (1/2/3):", reply_markup=KB_SHIFT_PICK)
     return ASSIGN_SHIFT_SHIFT
 
 async def assign_shift_shift(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -914,25 +1290,21 @@ async def assign_shift_shift(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await start(update, context)
         return ConversationHandler.END
 
-    if txt not in ["1", "2", "3"]:
+    shift_id = SHIFT_ID_BY_TEXT.get(txt)
+    if not shift_id:
         await update.message.reply_text("❌ فقط 1 یا 2 یا 3 بفرست.", reply_markup=kb_manager(update.effective_user.id))
         return ASSIGN_SHIFT_SHIFT
 
     emp_id = context.user_data.get("assign_user_id")
-    shift_id = int(txt)
 
-    set_employee_shift(emp_id, shift_id)
-    s = get_shift_by_id(shift_id)
+    await set_employee_shift(emp_id, shift_id)
 
     await update.message.reply_text(
-        f"✅ شیفت کارمند تنظیم شد: {s[1]} ({s[2]}-{s[3]})",
+        f"✅ شیفت کارمند تنظیم شد: {SHIFT_LABEL[shift_id]}",
         reply_markup=kb_manager(update.effective_user.id)
     )
 
-    try:
-        await context.bot.send_message(chat_id=emp_id, text=f"📌 شیفت شما تنظیم شد:\n\n{s[1]} ({s[2]}-{s[3]}) ✅")
-    except:
-        pass
+    enqueue_send(context.bot, chat_id=emp_id, text=SHIFT_ASSIGNED_TEXT.format(shift=SHIFT_LABEL[shift_id]))
 
     return ConversationHandler.END
 
@@ -948,263 +1320,224 @@ async def manager_note_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def manager_note_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = update.message.text.strip()
 
-    if txt in ["⬅️ بازگشت", "⬅️ بازگشت به منوی اصلی"]:
+    if txt in BACK_TEXTS:
         await start(update, context)
         return ConversationHandler.END
 
-    date_str = today_str()
+    now_iso = datetime.now().isoformat(timespec="seconds")
 
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
+    await db_write("""
         INSERT INTO manager_notes (date, note, created_at)
         VALUES (?, ?, ?)
-    """, (date_str, txt, datetime.now().isoformat(timespec="seconds")))
-    conn.commit()
-    conn.close()
+    """, (now_iso[:10], txt, now_iso))
 
     await update.message.reply_text("✅ پیام مدیر ثبت شد.", reply_markup=kb_manager(update.effective_user.id))
 
     return ConversationHandler.END
 
+def _clock(ts):
+    # Stored as fixed-width ISO "YYYY-MM-DDTHH:MM:SS"
+    return ts[11:] if ts else "—"
+
+def attendance_line(r):
+    return (
+        f"• {r['full_name']} | شیفت {r['shift_id']} | ورود: {_clock(r['check_in_time'])} "
+        f"| خروج: {_clock(r['check_out_time'])} | تاخیر: {r['delay_minutes']}m"
+    )
+
+def leave_line(lv):
+    return f"• {lv['full_name']} | {lv['status']} | {lv['reason']}"
+
 async def manager_report_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_USERS:
         return
 
     date_str = today_str()
 
-    conn = db()
-    c = conn.cursor()
-
-    c.execute("""
-        SELECT full_name, shift_id, check_in_time, check_out_time, delay_minutes
-        FROM attendance
-        WHERE date=?
-        ORDER BY shift_id, full_name
-    """, (date_str,))
-    rows = c.fetchall()
-
-    c.execute("""
-        SELECT full_name, reason, status
-        FROM leave_requests
-        WHERE date=?
-        ORDER BY created_at DESC
-    """, (date_str,))
-    leaves = c.fetchall()
-    conn.close()
-
-    text = f"📊 گزارش امروز ({date_str}) | {COMPANY_NAME}\n\n"
-    if rows:
-        text += "✅ حضور و غیاب:\n"
-        for full_name, shift_id, cin, cout, delay in rows:
-            cin_t = cin.split('T')[-1] if cin else "—"
-            cout_t = cout.split('T')[-1] if cout else "—"
-            text += f"• {full_name} | شیفت {shift_id} | ورود: {cin_t} | خروج: {cout_t} | تاخیر: {delay}m\n"
-    else:
-        text += "— هنوز ورود/خروج ثبت نشده.\n"
+    text = _report_cache.get(date_str)
+    if text is None:
+        epoch = _report_epoch
+        rows = await db_read(_SQL_REPORT_ATTENDANCE, (date_str,))
 
-    text += "\n🏖️ مرخصی‌ها:\n"
-    if leaves:
-        for full_name, reason, status in leaves:
-            text += f"• {full_name} | {status} | {reason}\n"
-    else:
-        text += "— موردی ثبت نشده.\n"
+        leaves = await db_read(_SQL_REPORT_LEAVES, (date_str,))
+
+        if rows:
+            att_text = "✅ حضور و غیاب:\n" + "".join(f"{attendance_line(r)}\n" for r in rows)
+        else:
+            att_text = "— هنوز ورود/خروج ثبت نشده.\n"
+        leave_text = "".join(f"{leave_line(lv)}\n" for lv in leaves) or "— موردی ثبت نشده.\n"
 
-    await update.message.reply_text(text, reply_markup=kb_manager(update.effective_user.id))
+        text = f"📊 گزارش امروز ({date_str}) | {COMPANY_NAME}\n\n{att_text}\n🏖️ مرخصی‌ها:\n{leave_text}"
+        if epoch == _report_epoch:
+            _report_cache.clear()
+            _report_cache[date_str] = text
+    await reply_long(update.message, text, reply_markup=kb_manager(update.effective_user.id))
 
 # =============================================================================
 # Jobs: reminders + late alert + nightly report
 # =============================================================================
 async def job_shift_reminder(context: ContextTypes.DEFAULT_TYPE):
-    now = datetime.now()
-    for shift_id, shift_name, start_hhmm, end_hhmm in SHIFTS:
-        start_dt = datetime.combine(now.date(), parse_hhmm(start_hhmm))
-        remind_dt = start_dt - timedelta(minutes=REMINDER_MINUTES_BEFORE_SHIFT)
+    shift_id = context.job.data
+    prefix, suffix = REMINDER_PARTS[shift_id]
+    targets = await db_read(_SQL_SHIFT_MEMBERS, (shift_id,))
 
-        if abs((now - remind_dt).total_seconds()) < 60:
-            conn = db()
-            c = conn.cursor()
-            c.execute("SELECT user_id FROM employee_shifts WHERE shift_id=?", (shift_id,))
-            targets = [r[0] for r in c.fetchall()]
-            conn.close()
-
-            for uid in targets:
-                name = get_employee_full_name(uid) or ""
-                try:
-                    await context.bot.send_message(
-                        chat_id=uid,
-                        text=REMINDER_TEXT.format(
-                            name=name or "همکار عزیز",
-                            minutes=REMINDER_MINUTES_BEFORE_SHIFT,
-                            shift_name=shift_name,
-                            start=start_hhmm,
-                            end=end_hhmm,
-                        )
-                    )
-                except:
-                    pass
+    for r in targets:
+        enqueue_send(context.bot, chat_id=r["user_id"], text=prefix + (r["full_name"] or "همکار عزیز") + suffix)
 
 async def job_late_alert(context: ContextTypes.DEFAULT_TYPE):
-    now = datetime.now()
+    shift_id, shift_name, _, _ = SHIFTS_BY_ID[context.job.data]
     date_str = today_str()
 
-    for shift_id, shift_name, start_hhmm, _ in SHIFTS:
-        start_dt = datetime.combine(now.date(), parse_hhmm(start_hhmm))
-        alert_dt = start_dt + timedelta(minutes=LATE_ALERT_MINUTES_AFTER_SHIFT_START)
-
-        if abs((now - alert_dt).total_seconds()) < 60:
-            conn = db()
-            c = conn.cursor()
-
-            c.execute("SELECT user_id FROM employee_shifts WHERE shift_id=?", (shift_id,))
-            assigned = [r[0] for r in c.fetchall()]
-
-            c.execute("SELECT user_id FROM attendance WHERE date=? AND shift_id=? AND check_in_time IS NOT NULL", (date_str, shift_id))
-            checked = {r[0] for r in c.fetchall()}
-            conn.close()
-
-            late_people = [uid for uid in assigned if uid not in checked]
-            if late_people:
-                names = []
-                for uid in late_people:
-                    names.append(get_employee_full_name(uid) or str(uid))
-
-                await notify_real_managers(
-                    context,
-                    LATE_ALERT_TEXT.format(
-                        shift_name=shift_name,
-                        late=LATE_ALERT_MINUTES_AFTER_SHIFT_START,
-                        list="\n".join([f"• {n}" for n in names])
-                    )
-                )
+    late_people = await db_read(_SQL_LATE_MEMBERS, {"date": date_str, "shift": shift_id})
+    if late_people:
+        names = [r["full_name"] or str(r["user_id"]) for r in late_people]
+
+        notify_real_managers(
+            context,
+            LATE_ALERT_TEXT.format(
+                shift_name=shift_name,
+                late=LATE_ALERT_MINUTES_AFTER_SHIFT_START,
+                list="\n".join([f"• {n}" for n in names])
+            )
+        )
 
 async def job_nightly_report(context: ContextTypes.DEFAULT_TYPE):
-    now = datetime.now()
-    if now.hour != NIGHTLY_REPORT_HOUR or now.minute != NIGHTLY_REPORT_MINUTE:
-        return
-
     date_str = today_str()
-    conn = db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT full_name, shift_id, check_in_time, check_out_time, delay_minutes
-        FROM attendance
-        WHERE date=?
-        ORDER BY shift_id, full_name
-    """, (date_str,))
-    rows = c.fetchall()
-
-    c.execute("""
-        SELECT full_name, reason, status
-        FROM leave_requests
-        WHERE date=?
-        ORDER BY created_at DESC
-    """, (date_str,))
-    leaves = c.fetchall()
-    conn.close()
-
-    text = f"📌 گزارش شبانه ({date_str}) | {COMPANY_NAME}\n\n"
+    rows = await db_read(_SQL_REPORT_ATTENDANCE, (date_str,))
+
+    leaves = await db_read(_SQL_REPORT_LEAVES, (date_str,))
+
     if rows:
-        text += "✅ حضور و غیاب:\n"
-        for full_name, shift_id, cin, cout, delay in rows:
-            cin_t = cin.split('T')[-1] if cin else "—"
-            cout_t = cout.split('T')[-1] if cout else "—"
-            text += f"• {full_name} | شیفت {shift_id} | ورود: {cin_t} | خروج: {cout_t} | تاخیر: {delay}m\n"
+        att_text = "✅ حضور و غیاب:\n" + "".join(f"{attendance_line(r)}\n" for r in rows)
     else:
-        text += "— هیچ ورودی ثبت نشده.\n"
+        att_text = "— هیچ ورودی ثبت نشده.\n"
+    leave_text = "".join(f"{leave_line(lv)}\n" for lv in leaves) or "— موردی ثبت نشده.\n"
 
-    text += "\n🏖️ مرخصی‌ها:\n"
-    if leaves:
-        for full_name, reason, status in leaves:
-            text += f"• {full_name} | {status} | {reason}\n"
-    else:
-        text += "— موردی ثبت نشده.\n"
+    text = f"📌 گزارش شبانه ({date_str}) | {COMPANY_NAME}\n\n{att_text}\n🏖️ مرخصی‌ها:\n{leave_text}"
 
-    await notify_real_managers(context, text)
+    notify_real_managers(context, text)
 
 # =============================================================================
 # Router
 # =============================================================================
-async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip()
-    user_id = update.effective_user.id
-
-    if text == "👨‍💼 پنل مدیر":
-        return await manager_panel(update, context)
+async def leave_requests_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("✅ درخواست‌های مرخصی از طریق پیام‌های تایید/رد مدیریت می‌شوند.", reply_markup=kb_manager(update.effective_user.id))
 
-    if text == "👤 پنل کارمند":
-        return await employee_panel(update, context)
+async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("✅ منوی اصلی", reply_markup=kb_main(update.effective_user.id))
 
-    if text == "ℹ️ راهنما":
-        return await help_cmd(update, context)
+BUTTON_ROUTES = {
+    "👨‍💼 پنل مدیر": manager_panel,
+    "👤 پنل کارمند": employee_panel,
+    "ℹ️ راهنما": help_cmd,
 
     # Employee buttons
-    if text == "📌 ثبت‌نام کارمند":
-        await register_employee_start(update, context)
-        return
-
-    if text == "🕒 شیفت من":
-        return await my_shift(update, context)
-
-    if text == "✅ ثبت ورود":
-        return await employee_check_in(update, context)
-
-    if text == "❌ ثبت خروج":
-        return await employee_check_out(update, context)
-
-    if text == "📍 وضعیت امروز":
-        return await employee_status_today(update, context)
-
-    if text == "✍️ توضیح برای شیفت بعد":
-        return await employee_note_start(update, context)
-
-    if text == "📜 توضیح شیفت قبلی":
-        return await previous_shift_notes(update, context)
-
-    if text == "🏖️ درخواست مرخصی":
-        return await leave_start(update, context)
+    "📌 ثبت‌نام کارمند": register_employee_start,
+    "🕒 شیفت من": my_shift,
+    "✅ ثبت ورود": employee_check_in,
+    "❌ ثبت خروج": employee_check_out,
+    "📍 وضعیت امروز": employee_status_today,
+    "✍️ توضیح برای شیفت بعد": employee_note_start,
+    "📜 توضیح شیفت قبلی": previous_shift_notes,
+    "🏖️ درخواست مرخصی": leave_start,
 
     # Manager buttons
-    if text == "👥 تایید کارمندها":
-        return await manager_pending_employees(update, context)
+    "👥 تایید کارمندها": manager_pending_employees,
+    "🧾 لیست کارمندها": list_employees,
+    "🗓️ تعیین/تغییر شیفت": assign_shift_start,
+    "📝 پیام مدیر": manager_note_start,
+    "📊 گزارش امروز": manager_report_today,
+    "🏖️ مرخصی‌ها": leave_requests_info,
 
-    if text == "🧾 لیست کارمندها":
-        return await list_employees(update, context)
+    "⬅️ بازگشت به منوی اصلی": back_to_main,
+}
 
-    if text == "🗓️ تعیین/تغییر شیفت":
-        return await assign_shift_start(update, context)
+async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    handler = BUTTON_ROUTES.get(update.message.text.strip())
+    if handler:
+        await handler(update, context)
+        return
 
-    if text == "📝 پیام مدیر":
-        return await manager_note_start(update, context)
+    await update.message.reply_text("❓ متوجه نشدم. از دکمه‌ها استفاده کن.", reply_markup=kb_main(update.effective_user.id))
 
-    if text == "📊 گزارش امروز":
-        return await manager_report_today(update, context)
+# =============================================================================
+# WEB SERVER (Render keep-alive + webhook, on the bot's event loop)
+# =============================================================================
+async def home(request: Request):
+    return PlainTextResponse(f"✅ {COMPANY_NAME} - Shift Bot is running!")
 
-    if text == "🏖️ مرخصی‌ها":
-        await update.message.reply_text("✅ درخواست‌های مرخصی از طریق پیام‌های تایید/رد مدیریت می‌شوند.", reply_markup=kb_manager(user_id))
-        return
+async def healthz(request: Request):
+    # Render health check: no DB or bot access, empty body
+    return Response(status_code=204)
 
-    if text == "⬅️ بازگشت به منوی اصلی":
-        await update.message.reply_text("✅ منوی اصلی", reply_markup=kb_main(user_id))
-        return
+# user_id -> (menu button text, update_id) of that user's latest tap still waiting in the queue.
+# Only BUTTON_ROUTES taps are collapsed: text typed into a conversation state must never be
+# lost, and a dropped callback query would leave the button's spinner running.
+_queued_taps = {}
 
-    await update.message.reply_text("❓ متوجه نشدم. از دکمه‌ها استفاده کن.", reply_markup=kb_main(user_id))
+def _tap_key(update: Update):
+    text = update.message.text if update.message else None
+    return text if text and text.strip() in BUTTON_ROUTES else None
+
+async def release_tap(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user and _queued_taps.get(user.id, (None, None))[1] == update.update_id:
+        del _queued_taps[user.id]
+
+async def telegram_webhook(request: Request):
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return Response(status_code=403)
+    application = request.app.state.application
+    update = Update.de_json(await request.json(), application.bot)
+    user = update.effective_user
+    key = _tap_key(update)
+    if user and key is not None:
+        # Drop a repeat of the same tap while the previous one hasn't been picked up yet
+        if _queued_taps.get(user.id, (None, None))[0] == key:
+            return Response()
+        _queued_taps[user.id] = (key, update.update_id)
+    # Ack straight away; PTB's own update fetcher task dispatches from the queue
+    application.update_queue.put_nowait(update)
+    return Response()
+
+def build_web_app(application: Application):
+    routes = [Route("/", home), Route("/healthz", healthz, methods=["GET", "HEAD"])]
+    if WEBHOOK_URL:
+        routes.append(Route("/webhook", telegram_webhook, methods=["POST"]))
+    web_app = Starlette(routes=routes)
+    web_app.state.application = application
+    return web_app
 
 # =============================================================================
 # BOT MAIN
 # =============================================================================
+class WebServer(uvicorn.Server):
+    # uvicorn re-raises a captured SIGTERM once serve() returns, which kills the process
+    # before bot_main's shutdown runs. bot_main routes the signals to handle_exit instead.
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
+
 async def bot_main():
     init_db()
+    storage.start()
     # ✅ Auto-register SUPERUSER as approved employee
     for uid in SUPERUSER:
-        upsert_employee(
+        await upsert_employee(
             user_id=uid,
             username="arashkanani1985",
             full_name="Arash Kanani",
             status="approved"
         )
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = Application.builder().token(BOT_TOKEN)
+    if WEBHOOK_URL:
+        builder = builder.updater(None)
+    application = builder.build()
+
+    application.add_handler(TypeHandler(Update, release_tap), group=-3)
+    application.add_handler(TypeHandler(Update, preload_employee), group=-2)
+    application.add_handler(TypeHandler(Update, revive_chat), group=-1)
 
     # Commands
     application.add_handler(CommandHandler("start", start))
@@ -1216,31 +1549,31 @@ async def bot_main():
 
     # Conversations
     application.add_handler(ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^📌 ثبت‌نام کارمند$"), register_employee_start)],
+        entry_points=[MessageHandler(filters.Text({"📌 ثبت‌نام کارمند"}), register_employee_start)],
         states={REG_FULLNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_employee_save)]},
         fallbacks=[],
     ))
 
     application.add_handler(ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^✍️ توضیح برای شیفت بعد$"), employee_note_start)],
+        entry_points=[MessageHandler(filters.Text({"✍️ توضیح برای شیفت بعد"}), employee_note_start)],
         states={EMP_NOTE: [MessageHandler(filters.TEXT & ~filters.COMMAND, employee_note_save)]},
         fallbacks=[],
     ))
 
     application.add_handler(ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^🏖️ درخواست مرخصی$"), leave_start)],
+        entry_points=[MessageHandler(filters.Text({"🏖️ درخواست مرخصی"}), leave_start)],
         states={LEAVE_REASON: [MessageHandler(filters.TEXT & ~filters.COMMAND, leave_save)]},
         fallbacks=[],
     ))
 
     application.add_handler(ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^📝 پیام مدیر$"), manager_note_start)],
+        entry_points=[MessageHandler(filters.Text({"📝 پیام مدیر"}), manager_note_start)],
         states={MANAGER_NOTE: [MessageHandler(filters.TEXT & ~filters.COMMAND, manager_note_save)]},
         fallbacks=[],
     ))
 
     application.add_handler(ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^🗓️ تعیین/تغییر شیفت$"), assign_shift_start)],
+        entry_points=[MessageHandler(filters.Text({"🗓️ تعیین/تغییر شیفت"}), assign_shift_start)],
         states={
             ASSIGN_SHIFT_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, assign_shift_user)],
             ASSIGN_SHIFT_SHIFT: [MessageHandler(filters.TEXT & ~filters.COMMAND, assign_shift_shift)],
@@ -1251,27 +1584,86 @@ async def bot_main():
     # Router
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_buttons))
 
-    # Jobs
-    application.job_queue.run_repeating(job_shift_reminder, interval=60, first=10)
-    application.job_queue.run_repeating(job_late_alert, interval=60, first=20)
-    application.job_queue.run_repeating(job_nightly_report, interval=60, first=30)
-
-    await application.initialize()
-    await application.start()
-    await application.updater.start_polling()
+    # Jobs: fire once a day at the exact minute instead of polling every 60s
+    for shift_id, _, start_hhmm, _ in SHIFTS:
+        application.job_queue.run_daily(
+            job_shift_reminder, daily_time(start_hhmm, -REMINDER_MINUTES_BEFORE_SHIFT),
+            data=shift_id, name=f"reminder-{shift_id}",
+        )
+        application.job_queue.run_daily(
+            job_late_alert, daily_time(start_hhmm, LATE_ALERT_MINUTES_AFTER_SHIFT_START),
+            data=shift_id, name=f"late-alert-{shift_id}",
+        )
+    application.job_queue.run_daily(
+        job_nightly_report, dtime(NIGHTLY_REPORT_HOUR, NIGHTLY_REPORT_MINUTE, tzinfo=LOCAL_TZ),
+        name="nightly-report",
+    )
 
-    print("✅ Telegram bot polling started!")
-    await asyncio.Event().wait()
+    # No per-request access log: every webhook POST would otherwise print a line.
+    # log_config=None leaves uvicorn's loggers propagating into our queued root handler.
+    webserver = WebServer(uvicorn.Config(
+        build_web_app(application), host="0.0.0.0", port=PORT, use_colors=False, access_log=False,
+        log_config=None,
+    ))
 
-def run_bot_thread():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(bot_main())
+    async with application:
+        await application.start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL}/webhook",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+            log.info("Telegram webhook set")
+        else:
+            await application.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+            log.info("Telegram bot polling started")
+
+        send_workers = [asyncio.create_task(send_worker()) for _ in range(SEND_CONCURRENCY)]
+
+        # SIGTERM (Render's stop signal) / SIGINT just end serve(); the teardown below then runs
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, webserver.handle_exit, sig, None)
+
+        log.info("Web server running on PORT=%d", PORT)
+        await webserver.serve()
+
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+
+        # Handlers and jobs are done enqueueing now; deliver what's left while the bot is still up
+        try:
+            await asyncio.wait_for(_send_queue.join(), timeout=10)
+        except asyncio.TimeoutError:
+            log.warning("shutting down with %d unsent messages", _send_queue.qsize())
+        for task in send_workers:
+            task.cancel()
+    log.info("Shutdown complete")
+
+def setup_logging():
+    # Handlers on the loop only enqueue records; the listener thread does the blocking stdout writes
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+        handlers=[logging.handlers.QueueHandler(log_queue)],
+    )
+    # httpx logs every Bot API request at INFO, apscheduler every job it adds
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    return listener
+
+async def main():
+    listener = setup_logging()
+    try:
+        await bot_main()
+    finally:
+        # Runs after bot_main's teardown (SIGTERM included); flushes whatever records are still queued
+        listener.stop()
 
 if __name__ == "__main__":
-    # Start bot in thread
-    threading.Thread(target=run_bot_thread, daemon=True).start()
-
-    # Start Flask for Render keep-alive
-    print(f"✅ Flask running on PORT={PORT}")
-    app.run(host="0.0.0.0", port=PORT)
+    asyncio.run(main())
@@ -0,0 +1,32 @@
+import os
+import unittest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test-token")
+
+from bot import MESSAGE_MAX_LENGTH, _utf16_len, split_message
+
+
+class SplitMessageTest(unittest.TestCase):
+    def test_short_text_is_one_part(self):
+        self.assertEqual(split_message("سلام\nhello"), ["سلام\nhello"])
+
+    def test_astral_text_is_measured_in_utf16_units(self):
+        # 3000 emoji are 3000 code points but 6000 UTF-16 units
+        parts = split_message("😀" * 3000)
+        self.assertEqual([_utf16_len(p) for p in parts], [4096, 1904])
+        self.assertEqual("".join(parts), "😀" * 3000)
+
+    def test_whitespace_only_tail_is_dropped(self):
+        text = "a" * MESSAGE_MAX_LENGTH + "\n"
+        self.assertEqual(split_message(text), ["a" * MESSAGE_MAX_LENGTH])
+
+    def test_lines_are_kept_whole(self):
+        line = "x" * 100 + "\n"
+        parts = split_message(line * 50)
+        self.assertTrue(all(_utf16_len(p) <= MESSAGE_MAX_LENGTH for p in parts))
+        self.assertTrue(all(p.endswith("\n") for p in parts))
+        self.assertEqual("".join(parts), line * 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import contextlib
+import os
+import sqlite3
+import tempfile
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+os.environ.setdefault("BOT_TOKEN", "123456:test-token")
+
+import bot
+
+INSERT = "INSERT INTO items (id, name) VALUES (?, ?)"
+
+
+class StorageWorkerBatchTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "test.db")
+        for patcher in (mock.patch.object(bot, "DB_NAME", self.path), mock.patch.object(bot, "_CONN", None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        bot.db().execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)")
+        self.addCleanup(lambda: bot.db().close())
+
+    def flush(self, *items):
+        batch = [(sql, params, Future()) for sql, params in items]
+        bot.StorageWorker()._flush(batch)
+        return [fut for _, _, fut in batch]
+
+    def stored(self):
+        with contextlib.closing(sqlite3.connect(self.path)) as conn:
+            return conn.execute("SELECT id, name FROM items ORDER BY id").fetchall()
+
+    def test_constraint_violation_fails_only_its_own_write(self):
+        first, second, duplicate = self.flush((INSERT, (1, "a")), (INSERT, (2, "b")), (INSERT, (1, "again")))
+        self.assertEqual(first.result(), [])
+        self.assertEqual(second.result(), [])
+        self.assertIsInstance(duplicate.exception(), sqlite3.IntegrityError)
+        self.assertEqual(self.stored(), [(1, "a"), (2, "b")])
+
+    def test_returning_rows_reach_their_future(self):
+        first, second, returning = self.flush(
+            (INSERT, (1, "a")), (INSERT, (2, "b")), (INSERT + " RETURNING id", (3, "c")),
+        )
+        self.assertEqual(first.result(), [])
+        self.assertEqual(second.result(), [])
+        self.assertEqual([tuple(row) for row in returning.result()], [(3,)])
+        self.assertEqual(self.stored(), [(1, "a"), (2, "b"), (3, "c")])
+
+
+if __name__ == "__main__":
+    unittest.main()